@@ -1,17 +1,23 @@
 import argparse
+import heapq
 import javaproperties
 import logging
 import signal
 import sys
+import threading
 
 from jog import JogFormatter
 from kafka import KafkaConsumer
+from kafka.client_async import KafkaClient
 from prometheus_client import start_http_server
 from prometheus_client.core import REGISTRY
 
-from . import scheduler, collectors
-from .fetch_jobs import setup_fetch_jobs
-from .parsing import parse_key, parse_value
+from . import collectors
+from .fetch_jobs import setup_fetch_jobs, run_fetch_jobs
+from .parsing import parse_commit_key, parse_value, trim_commit_key_cache
+
+# Maximum number of __consumer_offsets messages to handle per batch.
+POLL_MAX_RECORDS = 5000
 
 
 # Check if a dict contains a key, returning
@@ -28,6 +34,37 @@ def ensure_dict_key(curr_dict, key, new_value):
     return new_dict
 
 
+# Copy the consumer group dicts if they haven't been already
+# this batch, so keys can be added to or removed from the copies
+# without disturbing other threads iterating over the originals.
+# All three dicts always have the same keys, so are copied together.
+def copy_group_dicts(copied, offsets, commits, commit_timestamps):
+    if copied:
+        return (copied, offsets, commits, commit_timestamps)
+
+    return (True, offsets.copy(), commits.copy(), commit_timestamps.copy())
+
+
+# Drop the (group, topic, partition) keys with the oldest
+# commit timestamps from the dicts until at most max_keys
+# remain. Modifies the dicts in place.
+def remove_oldest_keys(max_keys, commit_timestamps, *other_dicts):
+    excess = len(commit_timestamps) - max_keys
+    oldest = heapq.nsmallest(excess, commit_timestamps, key=commit_timestamps.get)
+
+    for curr_dict in (commit_timestamps, *other_dicts):
+        for key in oldest:
+            curr_dict.pop(key, None)
+
+
+def positive_int(value):
+    num = int(value)
+    if num < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+
+    return num
+
+
 def shutdown():
     logging.info('Shutting down')
     sys.exit(1)
@@ -63,6 +100,11 @@ def main():
     parser.add_argument(
         '--low-water-interval', type=float, default=10.0,
         help='How often to refresh low-water information, in seconds. (default: 10)')
+    parser.add_argument(
+        '--max-series', type=positive_int,
+        help='Maximum number of consumer group partitions to report metrics for.' +
+        ' When exceeded, the partitions with the oldest commits are dropped.' +
+        ' (default: unlimited)')
     parser.add_argument(
         '--consumer-config', action='append', default=[],
         help='Provide additional Kafka consumer config as a consumer.properties file. Multiple files will be merged, later files having precedence.')
@@ -92,12 +134,12 @@ def main():
     logging.captureWarnings(True)
 
     port = args.port
+    max_series = args.max_series
 
     consumer_config = {
         'bootstrap_servers': 'localhost',
         'auto_offset_reset': 'latest',
-        'group_id': None,
-        'consumer_timeout_ms': 500
+        'group_id': None
     }
 
     for filename in args.consumer_config:
@@ -118,7 +160,11 @@ def main():
         '__consumer_offsets',
         **consumer_config
     )
-    client = consumer._client
+
+    # Topic and high/low-water requests get their own client, run in
+    # a separate thread, so they aren't held up while the consumer is
+    # busy working through a backlog of messages.
+    fetch_client = KafkaClient(**consumer_config)
 
     topic_interval = args.topic_interval
     high_water_interval = args.high_water_interval
@@ -128,6 +174,11 @@ def main():
     start_http_server(port)
     logging.info('Server started on port %s', port)
 
+    # Consumer group metrics are only published after the oldest
+    # series are dropped, so at most max_series are ever collected.
+    if max_series is not None:
+        collectors.set_group_label_cache_size(max_series)
+
     REGISTRY.register(collectors.HighwaterCollector())
     REGISTRY.register(collectors.LowwaterCollector())
     REGISTRY.register(collectors.ConsumerOffsetCollector())
@@ -139,108 +190,85 @@ def main():
     REGISTRY.register(collectors.ExporterLagCollector())
     REGISTRY.register(collectors.ExporterLeadCollector())
 
-    scheduled_jobs = setup_fetch_jobs(topic_interval, high_water_interval, low_water_interval, client)
-    scheduler.run_scheduled_jobs(scheduled_jobs)
+    scheduled_jobs = setup_fetch_jobs(topic_interval, high_water_interval, low_water_interval, fetch_client)
+    fetch_thread = threading.Thread(target=run_fetch_jobs,
+                                    args=(scheduled_jobs, fetch_client),
+                                    name='FetchJobs', daemon=True)
+    fetch_thread.start()
 
     try:
         while True:
-            for message in consumer:
-                offsets = collectors.get_offsets()
-                commits = collectors.get_commits()
-                commit_timestamps = collectors.get_commit_timestamps()
-                exporter_offsets = collectors.get_exporter_offsets()
-
-                exporter_partition = message.partition
-                exporter_offset = message.offset
-                exporter_offsets = ensure_dict_key(exporter_offsets, exporter_partition, exporter_offset)
-                exporter_offsets[exporter_partition] = exporter_offset
-                collectors.set_exporter_offsets(exporter_offsets)
-
-                if message.key:
-                    key_dict = parse_key(message.key)
-                    # Only key versions 0 and 1 are offset commit messages.
-                    # Ignore other versions.
-                    if key_dict is not None and key_dict['version'] in (0, 1):
-
-                        if message.value:
-                            value_dict = parse_value(message.value)
-                            if value_dict is not None:
-                                group = key_dict['group']
-                                topic = key_dict['topic']
-                                partition = key_dict['partition']
-                                offset = value_dict['offset']
-                                commit_timestamp = value_dict['commit_timestamp'] / 1000
-
-                                offsets = ensure_dict_key(offsets, group, {})
-                                offsets[group] = ensure_dict_key(offsets[group], topic, {})
-                                offsets[group][topic] = ensure_dict_key(offsets[group][topic], partition, offset)
-                                offsets[group][topic][partition] = offset
-                                collectors.set_offsets(offsets)
-
-                                commits = ensure_dict_key(commits, group, {})
-                                commits[group] = ensure_dict_key(commits[group], topic, {})
-                                commits[group][topic] = ensure_dict_key(commits[group][topic], partition, 0)
-                                commits[group][topic][partition] += 1
-                                collectors.set_commits(commits)
-
-                                commit_timestamps = ensure_dict_key(commit_timestamps, group, {})
-                                commit_timestamps[group] = ensure_dict_key(commit_timestamps[group], topic, {})
-                                commit_timestamps[group][topic] = ensure_dict_key(commit_timestamps[group][topic], partition, 0)
-                                commit_timestamps[group][topic][partition] = commit_timestamp
-                                collectors.set_commit_timestamps(commit_timestamps)
-
-                        else:
-                            # The group has been removed, so we should not report metrics
-                            group = key_dict['group']
-                            topic = key_dict['topic']
-                            partition = key_dict['partition']
-
-                            if group in offsets:
-                                if topic in offsets[group]:
-                                    if partition in offsets[group][topic]:
-                                        del offsets[group][topic][partition]
-
-                            if group in commits:
-                                if topic in commits[group]:
-                                    if partition in commits[group][topic]:
-                                        del commits[group][topic][partition]
-
-                            if group in commit_timestamps:
-                                if topic in commit_timestamps[group]:
-                                    if partition in commit_timestamps[group][topic]:
-                                        del commit_timestamps[group][topic][partition]
-
-                elif message.key and not message.value:
-                    # The group has been removed, so we should not report metrics
-                    key_dict = parse_key(message.key)
-                    if key_dict is not None and key_dict['version'] in (0, 1):
-                        group = key_dict['group']
-                        topic = key_dict['topic']
-                        partition = key_dict['partition']
-
-                        if group in offsets:
-                            if topic in offsets[group]:
-                                if partition in offsets[group][topic]:
-                                    del offsets[group][topic][partition]
-
-                        if group in commits:
-                            if topic in commits[group]:
-                                if partition in commits[group][topic]:
-                                    del commits[group][topic][partition]
-                        
-                        if group in commit_timestamps:
-                            if topic in commit_timestamps[group]:
-                                if partition in commit_timestamps[group][topic]:
-                                    del commit_timestamps[group][topic][partition]
-
-                # Check if we need to run any scheduled jobs
-                # each message.
-                scheduled_jobs = scheduler.run_scheduled_jobs(scheduled_jobs)
-
-            # Also check if we need to run any scheduled jobs
-            # each time the consumer times out, in case there
-            # aren't any messages to consume.
-            scheduled_jobs = scheduler.run_scheduled_jobs(scheduled_jobs)
+            records = consumer.poll(timeout_ms=1000, max_records=POLL_MAX_RECORDS)
+
+            offsets = collectors.get_offsets()
+            commits = collectors.get_commits()
+            commit_timestamps = collectors.get_commit_timestamps()
+            exporter_offsets = collectors.get_exporter_offsets()
+
+            # Other threads may be iterating over the consumer group
+            # dicts, so keys can't be added or removed in place.
+            # Instead the dicts are copied on the first key added or
+            # removed in a batch, the copies are modified for the rest
+            # of the batch, and they are published at the end of it.
+            copied = False
+
+            for topic_partition, messages in records.items():
+                for message in messages:
+                    if message.key:
+                        key = parse_commit_key(message.key)
+                        if key is not None:
+                            if message.value:
+                                value_dict = parse_value(message.value)
+                                if value_dict is not None:
+                                    offset = value_dict['offset']
+                                    commit_timestamp = value_dict['commit_timestamp'] / 1000
+
+                                    if key not in offsets:
+                                        copied, offsets, commits, commit_timestamps = copy_group_dicts(copied, offsets, commits, commit_timestamps)
+
+                                        commits[key] = 0
+
+                                    offsets[key] = offset
+                                    commits[key] += 1
+                                    commit_timestamps[key] = commit_timestamp
+
+                            elif key in offsets:
+                                # The group has been removed, so we should not report metrics
+                                copied, offsets, commits, commit_timestamps = copy_group_dicts(copied, offsets, commits, commit_timestamps)
+
+                                del offsets[key]
+                                del commits[key]
+                                del commit_timestamps[key]
+
+                # Only the exporter's latest offset is reported, so
+                # update it once per batch rather than every message.
+                if messages:
+                    exporter_partition = topic_partition.partition
+                    exporter_offset = messages[-1].offset
+                    exporter_offsets = ensure_dict_key(exporter_offsets, exporter_partition, exporter_offset)
+                    exporter_offsets[exporter_partition] = exporter_offset
+                    collectors.set_exporter_offsets(exporter_offsets)
+
+            # Checked once per batch, rather than every message,
+            # as finding the oldest commits is relatively expensive.
+            if max_series is not None and len(commit_timestamps) > max_series:
+                logging.debug('Dropping metrics for %(count)s consumer group partitions'
+                              ' with the oldest commits',
+                              {'count': len(commit_timestamps) - max_series})
+
+                copied, offsets, commits, commit_timestamps = copy_group_dicts(copied, offsets, commits, commit_timestamps)
+
+                remove_oldest_keys(max_series, commit_timestamps, offsets, commits)
+
+            if copied:
+                collectors.set_offsets(offsets)
+                collectors.set_commits(commits)
+                collectors.set_commit_timestamps(commit_timestamps)
+
+            # Bound the key cache by the number of consumer group
+            # partitions we're tracking, allowing for each having both
+            # a version 0 and 1 key, and for a batch of new keys.
+            trim_commit_key_cache(2 * len(offsets) + POLL_MAX_RECORDS)
 
     except KeyboardInterrupt:
         pass
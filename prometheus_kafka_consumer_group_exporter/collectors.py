@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
 
 from .fetch_jobs import build_highwaters, build_lowwaters
@@ -5,9 +7,9 @@ from .fetch_jobs import build_highwaters, build_lowwaters
 METRIC_PREFIX = 'kafka_consumer_group_'
 
 # Globals
-offsets = {}  # group->topic->partition->offset
-commits = {}  # group->topic->partition->commits
-commit_timestamps = {}  # group->topic->partition->commit_timestamp
+offsets = {}  # (group, topic, partition)->offset
+commits = {}  # (group, topic, partition)->commits
+commit_timestamps = {}  # (group, topic, partition)->commit_timestamp
 exporter_offsets = {}  # partition->offset
 
 
@@ -47,53 +49,46 @@ def set_exporter_offsets(new_exporter_offsets):
     exporter_offsets = new_exporter_offsets
 
 
-def group_metrics(metrics):
-    metric_dict = {}
-    for (metric_name, metric_doc, label_keys, label_values, value) in metrics:
-        if metric_name not in metric_dict:
-            metric_dict[metric_name] = (metric_doc, label_keys, {})
+def label_strings(label_values):
+    return tuple(str(v) for v in label_values)
 
-        metric_dict[metric_name][2][label_values] = value
 
-    return metric_dict
+# The same (group, topic, partition) label values are converted
+# every scrape, by five metrics (offset, lag, lead, commits and
+# commit timestamp). Caching the conversion only helps if every
+# series fits in the cache - each scrape walks all the series in
+# order, so a smaller LRU cache evicts every entry before it is
+# reused. So the conversion is only cached when the number of
+# series is bounded, with a cache sized to fit them all.
+group_label_strings = label_strings
 
 
-def gauge_generator(metrics):
-    metric_dict = group_metrics(metrics)
+def set_group_label_cache_size(size):
+    global group_label_strings
+    group_label_strings = lru_cache(maxsize=size)(label_strings)
 
-    for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
-        # If we have label keys we may have multiple different values,
-        # each with their own label values.
-        if label_keys:
-            gauge = GaugeMetricFamily(metric_name, metric_doc, labels=label_keys)
 
-            for label_values in sorted(value_dict.keys()):
-                value = value_dict[label_values]
-                gauge.add_metric(tuple(str(v) for v in label_values), value)
+# Each collector exports a single metric with a fixed name and label
+# keys, so the values are passed as a dict mapping label value tuples
+# to metric values, rather than needing to be grouped by metric name.
+def gauge_generator(metric_name, metric_doc, label_keys, values,
+                    convert_labels=label_strings):
+    if values:
+        gauge = GaugeMetricFamily(metric_name, metric_doc, labels=label_keys)
 
-        # No label keys, so we must have only a single value.
-        else:
-            gauge = GaugeMetricFamily(metric_name, metric_doc, value=list(value_dict.values())[0])
+        for label_values in sorted(values.keys()):
+            gauge.add_metric(convert_labels(label_values), values[label_values])
 
         yield gauge
 
 
-def counter_generator(metrics):
-    metric_dict = group_metrics(metrics)
-
-    for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
-        # If we have label keys we may have multiple different values,
-        # each with their own label values.
-        if label_keys:
-            counter = CounterMetricFamily(metric_name, metric_doc, labels=label_keys)
-
-            for label_values in sorted(value_dict.keys()):
-                value = value_dict[label_values]
-                counter.add_metric(tuple(str(v) for v in label_values), value)
+def counter_generator(metric_name, metric_doc, label_keys, values,
+                      convert_labels=label_strings):
+    if values:
+        counter = CounterMetricFamily(metric_name, metric_doc, labels=label_keys)
 
-        # No label keys, so we must have only a single value.
-        else:
-            counter = CounterMetricFamily(metric_name, metric_doc, value=list(value_dict.values())[0])
+        for label_values in sorted(values.keys()):
+            counter.add_metric(convert_labels(label_values), values[label_values])
 
         yield counter
 
@@ -102,114 +97,92 @@ class HighwaterCollector(object):
 
     def collect(self):
         highwaters = build_highwaters()
-        metrics = [
-            ('kafka_topic_highwater', 'The offset of the head of a partition in a topic.',
-             ('topic', 'partition'), (topic, partition),
-             highwater)
+        values = {
+            (topic, partition): highwater
             for topic, partitions in highwaters.items()
             for partition, highwater in partitions.items()
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator('kafka_topic_highwater', 'The offset of the head of a partition in a topic.',
+                                   ('topic', 'partition'), values)
 
 
 class LowwaterCollector(object):
 
     def collect(self):
         lowwaters = build_lowwaters()
-        metrics = [
-            ('kafka_topic_lowwater', 'The offset of the tail of a partition in a topic.',
-             ('topic', 'partition'), (topic, partition),
-             lowwater)
+        values = {
+            (topic, partition): lowwater
             for topic, partitions in lowwaters.items()
             for partition, lowwater in partitions.items()
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator('kafka_topic_lowwater', 'The offset of the tail of a partition in a topic.',
+                                   ('topic', 'partition'), values)
 
 
 class ConsumerOffsetCollector(object):
 
     def collect(self):
-        metrics = [
-            (METRIC_PREFIX + 'offset', 'The current offset of a consumer group in a partition of a topic.',
-             ('group', 'topic', 'partition'), (group, topic, partition),
-             offset)
-            for group, topics in offsets.items()
-            for topic, partitions in topics.items()
-            for partition, offset in partitions.items()
-        ]
-        yield from gauge_generator(metrics)
+        # Offsets are already keyed by (group, topic, partition).
+        yield from gauge_generator(METRIC_PREFIX + 'offset', 'The current offset of a consumer group in a partition of a topic.',
+                                   ('group', 'topic', 'partition'), offsets,
+                                   group_label_strings)
 
 
 class ConsumerLagCollector(object):
 
     def collect(self):
         highwaters = build_highwaters()
-        metrics = [
-            (METRIC_PREFIX + 'lag', 'How far a consumer group\'s current offset is behind the head of a partition of a topic.',
-             ('group', 'topic', 'partition'), (group, topic, partition),
-             max(highwaters[topic][partition] - offset, 0))
-            for group, topics in offsets.items()
-            for topic, partitions in topics.items()
-            for partition, offset in partitions.items()
+        values = {
+            (group, topic, partition): max(highwaters[topic][partition] - offset, 0)
+            for (group, topic, partition), offset in offsets.items()
             if topic in highwaters and partition in highwaters[topic]
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator(METRIC_PREFIX + 'lag', 'How far a consumer group\'s current offset is behind the head of a partition of a topic.',
+                                   ('group', 'topic', 'partition'), values,
+                                   group_label_strings)
 
 
 class ConsumerLeadCollector(object):
 
     def collect(self):
         lowwaters = build_lowwaters()
-        metrics = [
-            (METRIC_PREFIX + 'lead', 'How far a consumer group\'s current offset is ahead of the tail of a partition of a topic.',
-             ('group', 'topic', 'partition'), (group, topic, partition),
-             offset - lowwaters[topic][partition])
-            for group, topics in offsets.items()
-            for topic, partitions in topics.items()
-            for partition, offset in partitions.items()
+        values = {
+            (group, topic, partition): offset - lowwaters[topic][partition]
+            for (group, topic, partition), offset in offsets.items()
             if topic in lowwaters and partition in lowwaters[topic]
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator(METRIC_PREFIX + 'lead', 'How far a consumer group\'s current offset is ahead of the tail of a partition of a topic.',
+                                   ('group', 'topic', 'partition'), values,
+                                   group_label_strings)
 
 
 class ConsumerCommitsCollector(object):
 
     def collect(self):
-        metrics = [
-            (METRIC_PREFIX + 'commits', 'The number of commit messages read by the exporter consumer from a consumer group for a partition of a topic.',
-             ('group', 'topic', 'partition'), (group, topic, partition),
-             commit_count)
-            for group, topics in commits.items()
-            for topic, partitions in topics.items()
-            for partition, commit_count in partitions.items()
-        ]
-        yield from counter_generator(metrics)
+        # Commits are already keyed by (group, topic, partition).
+        yield from counter_generator(METRIC_PREFIX + 'commits', 'The number of commit messages read by the exporter consumer from a consumer group for a partition of a topic.',
+                                     ('group', 'topic', 'partition'), commits,
+                                     group_label_strings)
 
 
 class ConsumerCommitTimestampCollector(object):
 
     def collect(self):
-        metrics = [
-            (METRIC_PREFIX + 'commit_timestamp', 'The timestamp of the latest commit from a consumer group for a partition of a topic.',
-             ('group', 'topic', 'partition'), (group, topic, partition),
-             commit_timestamp)
-            for group, topics in commit_timestamps.items()
-            for topic, partitions in topics.items()
-            for partition, commit_timestamp in partitions.items()
-        ]
-        yield from gauge_generator(metrics)
+        # Commit timestamps are already keyed by (group, topic, partition).
+        yield from gauge_generator(METRIC_PREFIX + 'commit_timestamp', 'The timestamp of the latest commit from a consumer group for a partition of a topic.',
+                                   ('group', 'topic', 'partition'), commit_timestamps,
+                                   group_label_strings)
 
 
 class ExporterOffsetCollector(object):
 
     def collect(self):
-        metrics = [
-            (METRIC_PREFIX + 'exporter_offset', 'The current offset of the exporter consumer in a partition of the __consumer_offsets topic.',
-             ('partition',), (partition,),
-             offset)
+        values = {
+            (partition,): offset
             for partition, offset in exporter_offsets.items()
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator(METRIC_PREFIX + 'exporter_offset', 'The current offset of the exporter consumer in a partition of the __consumer_offsets topic.',
+                                   ('partition',), values)
 
 
 class ExporterLagCollector(object):
@@ -217,14 +190,13 @@ class ExporterLagCollector(object):
     def collect(self):
         topic = '__consumer_offsets'
         highwaters = build_highwaters()
-        metrics = [
-            (METRIC_PREFIX + 'exporter_lag', 'How far the exporter consumer is behind the head of a partition of the __consumer_offsets topic.',
-             ('partition',), (partition,),
-             max(highwaters[topic][partition] - offset, 0))
+        values = {
+            (partition,): max(highwaters[topic][partition] - offset, 0)
             for partition, offset in exporter_offsets.items()
             if topic in highwaters and partition in highwaters[topic]
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator(METRIC_PREFIX + 'exporter_lag', 'How far the exporter consumer is behind the head of a partition of the __consumer_offsets topic.',
+                                   ('partition',), values)
 
 
 class ExporterLeadCollector(object):
@@ -232,11 +204,10 @@ class ExporterLeadCollector(object):
     def collect(self):
         topic = '__consumer_offsets'
         lowwaters = build_lowwaters()
-        metrics = [
-            (METRIC_PREFIX + 'exporter_lead', 'How far the exporter consumer is ahead of the tail of a partition of the __consumer_offsets topic.',
-             ('partition',), (partition,),
-             offset - lowwaters[topic][partition])
+        values = {
+            (partition,): offset - lowwaters[topic][partition]
             for partition, offset in exporter_offsets.items()
             if topic in lowwaters and partition in lowwaters[topic]
-        ]
-        yield from gauge_generator(metrics)
+        }
+        yield from gauge_generator(METRIC_PREFIX + 'exporter_lead', 'How far the exporter consumer is ahead of the tail of a partition of the __consumer_offsets topic.',
+                                   ('partition',), values)
@@ -9,6 +9,7 @@ from . import scheduler
 
 # Globals
 topics = {}  # topic->partition->leader
+leader_partitions = {}  # leader->topic->partitions
 node_highwaters = {}  # node->topic->partition->highwater
 node_lowwaters = {}  # node->topic->partition->lowwater
 
@@ -44,8 +45,6 @@ def build_lowwaters():
 
 
 def fetch_topics(client, callback):
-    logging.info('Requesting topics and partition assignments')
-
     try:
         node = client.least_loaded_node()
 
@@ -63,17 +62,11 @@ def fetch_topics(client, callback):
 
 def fetch_highwater(client, callback):
     try:
-        if topics:
-            logging.info('Requesting high-water marks')
-
-            nodes = {}
-            for topic, partition_map in topics.items():
-                for partition, leader in partition_map.items():
-                    if leader not in nodes:
-                        nodes[leader] = {}
-                    if topic not in nodes[leader]:
-                        nodes[leader][topic] = []
-                    nodes[leader][topic].append(partition)
+        # Take a local reference, as leader_partitions is
+        # replaced wholesale when topics are updated.
+        nodes = leader_partitions
+        if nodes:
+            logging.debug('Requesting high-water marks')
 
             global node_highwaters
             # Build a new highwaters dict with only the nodes that
@@ -92,7 +85,7 @@ def fetch_highwater(client, callback):
 
             for node, topic_map in nodes.items():
                 logging.debug('Requesting high-water marks from %(node)s',
-                              {'topic': topic, 'node': node})
+                              {'node': node})
 
                 request = OffsetRequest[0](
                     -1,
@@ -110,17 +103,11 @@ def fetch_highwater(client, callback):
 
 def fetch_lowwater(client, callback):
     try:
-        if topics:
-            logging.info('Requesting low-water marks')
-
-            nodes = {}
-            for topic, partition_map in topics.items():
-                for partition, leader in partition_map.items():
-                    if leader not in nodes:
-                        nodes[leader] = {}
-                    if topic not in nodes[leader]:
-                        nodes[leader][topic] = []
-                    nodes[leader][topic].append(partition)
+        # Take a local reference, as leader_partitions is
+        # replaced wholesale when topics are updated.
+        nodes = leader_partitions
+        if nodes:
+            logging.debug('Requesting low-water marks')
 
             global node_lowwaters
             # Build a new node_lowwaters dict with only the nodes that
@@ -139,7 +126,7 @@ def fetch_lowwater(client, callback):
 
             for node, topic_map in nodes.items():
                 logging.debug('Requesting low-water marks from %(node)s',
-                              {'topic': topic, 'node': node})
+                              {'node': node})
 
                 request = OffsetRequest[0](
                     -1,
@@ -156,7 +143,7 @@ def fetch_lowwater(client, callback):
 
 
 def update_topics(api_version, metadata):
-    logging.info('Received topics and partition assignments')
+    logging.debug('Received topics and partition assignments')
 
     if api_version == 0:
         TOPIC_ERROR = 0
@@ -200,12 +187,33 @@ def update_topics(api_version, metadata):
 
             new_topics[topic] = new_partitions
 
-    global topics
+    global topics, leader_partitions
+
+    # Topics and leaders rarely change, so keep the current
+    # dicts if nothing has, rather than regrouping the
+    # partitions and replacing them.
+    if new_topics == topics:
+        return
+
+    # Group partitions by their leader here, rather than each time
+    # we request high/low-water marks, as the marks are requested
+    # from the leader of each partition, and more often than topics.
+    new_leader_partitions = {}
+    for topic, partition_map in new_topics.items():
+        for partition, leader in partition_map.items():
+            if leader not in new_leader_partitions:
+                new_leader_partitions[leader] = {}
+            if topic not in new_leader_partitions[leader]:
+                new_leader_partitions[leader][topic] = []
+            new_leader_partitions[leader][topic].append(partition)
+
     topics = new_topics
+    leader_partitions = new_leader_partitions
 
 
 def update_highwater(node, offsets):
-    logging.info('Received high-water marks from node {}'.format(node))
+    logging.debug('Received high-water marks from node %(node)s',
+                  {'node': node})
 
     highwaters = {}
     for topic, partitions in offsets.topics:
@@ -229,7 +237,8 @@ def update_highwater(node, offsets):
 
 
 def update_lowwater(node, offsets):
-    logging.info('Received low-water marks from node {}'.format(node))
+    logging.debug('Received low-water marks from node %(node)s',
+                  {'node': node})
 
     lowwaters = {}
     for topic, partitions in offsets.topics:
@@ -265,3 +274,20 @@ def setup_fetch_jobs(topic_interval, high_water_interval, low_water_interval,
     jobs = scheduler.add_scheduled_job(jobs, low_water_interval,
                                        fetch_lowwater, client, update_lowwater)
     return jobs
+
+
+def run_fetch_jobs(jobs, client):
+    # Runs forever, so should be run in its own thread.
+    # The client should not be shared with other threads.
+    while True:
+        try:
+            jobs = scheduler.run_scheduled_jobs(jobs)
+
+            # Send the requests made by the jobs and handle any
+            # responses, waking up in time to run the next job.
+            timeout = scheduler.time_until_next_job(jobs)
+            timeout_ms = 1000 if timeout is None else timeout * 1000
+            client.poll(timeout_ms=timeout_ms)
+
+        except Exception:
+            logging.exception('Error while running fetch jobs')
@@ -1,47 +1,62 @@
 import logging
-from struct import unpack_from, error as struct_error
+from struct import Struct, error as struct_error
 
+SHORT = Struct('>h')
+INT = Struct('>i')
+LONG_LONG = Struct('>q')
 
-def read_short(bytes):
-    num = unpack_from('>h', bytes)[0]
-    remaining = bytes[2:]
-    return (num, remaining)
+# Globals
+commit_keys = {}  # key bytes->(group, topic, partition)
 
 
-def read_int(bytes):
-    num = unpack_from('>i', bytes)[0]
-    remaining = bytes[4:]
-    return (num, remaining)
+# Each reader takes the buffer and the offset to read from,
+# returning the value read and the offset just past it.
+# Reading by offset avoids copying the remainder of the buffer
+# for every field.
+def read_short(buf, offset):
+    num = SHORT.unpack_from(buf, offset)[0]
+    return (num, offset + 2)
 
 
-def read_long_long(bytes):
-    num = unpack_from('>q', bytes)[0]
-    remaining = bytes[8:]
-    return (num, remaining)
+def read_int(buf, offset):
+    num = INT.unpack_from(buf, offset)[0]
+    return (num, offset + 4)
 
 
-def read_string(bytes):
-    length, remaining = read_short(bytes)
-    string = remaining[:length].decode('utf-8')
-    remaining = remaining[length:]
-    return (string, remaining)
+def read_long_long(buf, offset):
+    num = LONG_LONG.unpack_from(buf, offset)[0]
+    return (num, offset + 8)
+
+
+def read_string(buf, offset):
+    length, offset = read_short(buf, offset)
+    string = str(buf[offset:offset + length], 'utf-8')
+    return (string, offset + length)
+
+
+# Skip over a string without decoding it,
+# for fields we don't use.
+def skip_string(buf, offset):
+    length, offset = read_short(buf, offset)
+    return offset + length
 
 
 def parse_key(bytes):
     try:
-        (version, remaining_key) = read_short(bytes)
+        buf = memoryview(bytes)
+        (version, offset) = read_short(buf, 0)
         key_dict = {'version': version}
 
         # These two versions are for offset commit messages.
         if version == 1 or version == 0:
-            key_dict['group'], remaining_key = read_string(remaining_key)
-            key_dict['topic'], remaining_key = read_string(remaining_key)
-            key_dict['partition'], remaining_key = read_int(remaining_key)
+            key_dict['group'], offset = read_string(buf, offset)
+            key_dict['topic'], offset = read_string(buf, offset)
+            key_dict['partition'], offset = read_int(buf, offset)
 
         # This version is for group metadata messages.
         # (we don't support parsing their values currently)
         elif version == 2:
-            key_dict['group'], remaining_key = read_string(remaining_key)
+            key_dict['group'], offset = read_string(buf, offset)
 
         else:
             logging.error('Can\'t parse __consumer_offsets topic message key with'
@@ -57,32 +72,62 @@ def parse_key(bytes):
                           {'key_bytes': bytes})
 
 
+# Offset commit keys are repeated for every commit a consumer group
+# makes for a partition, so cache the parsed keys by their raw bytes
+# to avoid decoding the same group and topic names over and over.
+# Returns a (group, topic, partition) tuple for offset commit keys,
+# or None for other keys.
+def parse_commit_key(bytes):
+    # Group metadata messages (key version 2) are about as common
+    # as offset commit messages, so check for them before doing any
+    # parsing, and without filling up the key cache.
+    if len(bytes) >= 2 and bytes[0] == 0 and bytes[1] == 2:
+        return None
+
+    key = commit_keys.get(bytes)
+    if key is None:
+        key_dict = parse_key(bytes)
+
+        # Only key versions 0 and 1 are offset commit messages.
+        # Ignore other versions.
+        if key_dict is not None and key_dict['version'] in (0, 1):
+            key = (key_dict['group'], key_dict['topic'], key_dict['partition'])
+            commit_keys[bytes] = key
+
+    return key
+
+
+# Clear the key cache if it has grown past max_size, e.g. due to
+# consumer groups that have since been removed. It refills with the
+# keys still in use as their next commits are read.
+# Clearing, rather than evicting in LRU order, avoids the cache
+# missing on every lookup when more keys are in use than it can hold,
+# as keys are committed in cycles.
+def trim_commit_key_cache(max_size):
+    if len(commit_keys) > max_size:
+        commit_keys.clear()
+
+
 def parse_value(bytes):
     try:
-        (version, remaining_key) = read_short(bytes)
+        buf = memoryview(bytes)
+        (version, offset) = read_short(buf, 0)
         value_dict = {'version': version}
 
-        if version == 0:
-            value_dict['offset'], remaining_key = read_long_long(remaining_key)
-            value_dict['metadata'], remaining_key = read_string(remaining_key)
-            value_dict['timestamp'], remaining_key = read_long_long(remaining_key)
-
-        elif version == 1:
-            value_dict['offset'], remaining_key = read_long_long(remaining_key)
-            value_dict['metadata'], remaining_key = read_string(remaining_key)
-            value_dict['commit_timestamp'], remaining_key = read_long_long(remaining_key)
-            value_dict['expire_timestamp'], remaining_key = read_long_long(remaining_key)
-
-        elif version == 2:
-            value_dict['offset'], remaining_key = read_long_long(remaining_key)
-            value_dict['metadata'], remaining_key = read_string(remaining_key)
-            value_dict['commit_timestamp'], remaining_key = read_long_long(remaining_key)
+        # Only the offset and commit timestamp are used, so other
+        # fields (metadata, leader epoch, expire timestamp) are skipped.
+        # Version 1 has a trailing expire timestamp, but otherwise
+        # matches versions 0 and 2 up to the commit timestamp.
+        if version in (0, 1, 2):
+            value_dict['offset'], offset = read_long_long(buf, offset)
+            offset = skip_string(buf, offset)
+            value_dict['commit_timestamp'], offset = read_long_long(buf, offset)
 
         elif version == 3:
-            value_dict['offset'], remaining_key = read_long_long(remaining_key)
-            value_dict['leader_epoch'], remaining_key = read_int(remaining_key)
-            value_dict['metadata'], remaining_key = read_string(remaining_key)
-            value_dict['commit_timestamp'], remaining_key = read_long_long(remaining_key)
+            value_dict['offset'], offset = read_long_long(buf, offset)
+            offset += 4  # leader_epoch
+            offset = skip_string(buf, offset)
+            value_dict['commit_timestamp'], offset = read_long_long(buf, offset)
 
         else:
             logging.error('Can\'t parse __consumer_offsets topic message value with'
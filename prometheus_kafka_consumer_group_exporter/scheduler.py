@@ -20,6 +20,11 @@ def run_scheduled_jobs(jobs):
 
     current_time = time.monotonic()
 
+    # Jobs are kept sorted, so if the first job isn't due yet none
+    # are, and we can return without building any new lists.
+    if jobs[0][0] > current_time:
+        return jobs
+
     # Sort jobs to run in scheduled time order to run them as
     # close to their scheduled time as possible.
     to_run = sorted(job for job in jobs if job[0] <= current_time)
@@ -48,3 +53,11 @@ def run_scheduled_jobs(jobs):
     # No real need to sort the jobs here, but nice to
     # if we're going to inspect the jobs list later.
     return sorted(jobs)
+
+
+def time_until_next_job(jobs):
+    if not jobs:
+        return None
+
+    # Jobs are kept sorted, so the first job is the next to run.
+    return max(jobs[0][0] - time.monotonic(), 0)